@@ -1,17 +1,21 @@
 import os
 import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
-# Do not check for violations in these directories.
-ignored_dirs = ["c_api", "cpp_api"]
+# Do not check for violations in these directories (or any hidden directory).
+ignored_dirs = {"c_api", "cpp_api"}
 
 # Do not check for violations in these files.
-ignored_files = [
+ignored_files = {
     "heap_profiler.h",
     "heap_profiler.cc",
     "heap_memory.h",
     "heap_memory.cc",
-]
+}
+
+# Only check for violations in files with these extensions.
+source_extensions = (".h", ".cc")
 
 # Match C API malloc:
 regex_malloc = re.compile(r"malloc\(")
@@ -67,7 +71,9 @@ free_exceptions = {
 #  new Foo (
 #  new (std::nothro) Foo (
 #  new (std::nothro) Foo [
-regex_new = re.compile(r"new\s+(\(std::nothrow\)+)?[a-zA-Z_][a-zA-Z0-9_]*\s*(\(|\[)")
+regex_new = re.compile(
+    r"new\s+(\(std::nothrow\)+)?[a-zA-Z_][a-zA-Z0-9_]*\s*(\(|\[)", re.ASCII
+)
 
 # Match C++ delete operators, examples:
 #  delete Foo;
@@ -75,7 +81,9 @@ regex_new = re.compile(r"new\s+(\(std::nothrow\)+)?[a-zA-Z_][a-zA-Z0-9_]*\s*(\(|
 #  delete Foo)
 #  delete [] Foo)
 #  delete *Foo;
-regex_delete = re.compile(r"delete\s*(\[\])?\s+(\*)?[a-zA-Z_][a-zA-Z0-9_]*\s*(;|\))")
+regex_delete = re.compile(
+    r"delete\s*(\[\])?\s+(\*)?[a-zA-Z_][a-zA-Z0-9_]*\s*(;|\))", re.ASCII
+)
 
 # Match C++ shared_ptr objects.
 regex_shared_ptr = re.compile(r"shared_ptr<")
@@ -128,122 +136,151 @@ unique_ptr_exceptions = {
     "curl.h": ["std::unique_ptr<CURL, decltype(&curl_easy_cleanup)>"],
 }
 
+# Name of this script, used as the prefix of reported violations.
+script_name = os.path.basename(__file__)
+
+
 # Reports a violation to stdout.
 def report_violation(file_path, line, substr):
     print(
-        "["
-        + os.path.basename(__file__)
-        + "]: "
-        + "Detected '"
-        + substr
-        + "' heap memory API violation:"
+        f"[{script_name}]: Detected '{substr}' heap memory API violation:\n"
+        f"  {file_path}\n"
+        f"  {line}"
     )
-    print("  " + file_path)
-    print("  " + line)
 
 
-# Checks if a given line contains a violation.
-def check_line(file_path, line, substr, compiled_regex, exceptions):
+# Returns the exceptions that apply to the file named `file_name`.
+def file_exceptions(exceptions, file_name):
+    if exceptions is None:
+        return ()
+    return tuple(exceptions.get("*", ())) + tuple(exceptions.get(file_name, ()))
+
+
+# Checks if a given (stripped) line contains a violation, given the exceptions
+# that apply to its file.
+def check_line(line, substr, compiled_regex, exceptions):
     if substr not in line:
-        return
+        return False
+
+    for exception in exceptions:
+        if exception in line:
+            return False
+
+    return compiled_regex.search(line) is not None
+
+
+# Checks performed on each line: (substring, regex, exceptions).
+line_checks = [
+    ("malloc", regex_malloc, malloc_exceptions),
+    ("calloc", regex_calloc, calloc_exceptions),
+    ("realloc", regex_realloc, realloc_exceptions),
+    ("free", regex_free, free_exceptions),
+    ("new", regex_new, None),
+    ("delete", regex_delete, None),
+    ("shared_ptr<", regex_shared_ptr, shared_ptr_exceptions),
+    ("make_shared<", regex_make_shared, make_shared_exceptions),
+    ("unique_ptr<", regex_unique_ptr, unique_ptr_exceptions),
+]
 
-    line = line.strip()
+# Matches the substring of any of the checks above; a line can only be flagged
+# if it contains one. Most lines do not, which lets us skip the individual
+# checks for them entirely. The plain literal alternation lets the regex engine
+# skip ahead quickly, and this is a bytes pattern so that files can be scanned
+# without decoding them.
+regex_any = re.compile("|".join(re.escape(check[0]) for check in line_checks).encode())
 
+
+# Returns the violations in a file as a list of (line, substr) tuples. The
+# whole file is scanned for candidates in one pass; only the lines containing
+# a candidate are passed on to the individual checks.
+def check_file(file_path):
+    violations = []
+    with open(file_path, "rb") as f:
+        text = f.read()
+
+    # Resolve the exceptions for this file once rather than on every line.
     file_name = os.path.basename(file_path)
+    file_checks = [
+        (substr, compiled_regex, file_exceptions(exceptions, file_name))
+        for substr, compiled_regex, exceptions in line_checks
+    ]
 
-    if exceptions is not None:
-        if "*" in exceptions:
-            for exception in exceptions["*"]:
-                if exception in line:
-                    return
-        if file_name in exceptions:
-            for exception in exceptions[file_name]:
-                if exception in line:
-                    return
+    pos = 0
+    while True:
+        match = regex_any.search(text, pos)
+        if match is None:
+            break
 
-    if compiled_regex.search(line) is not None:
-        report_violation(file_path, line, substr)
-        return True
+        line_start = text.rfind(b"\n", 0, match.start()) + 1
+        line_end = text.find(b"\n", match.start())
+        if line_end == -1:
+            line_end = len(text)
 
-    return False
+        # Only candidate lines are decoded.
+        line = text[line_start:line_end].decode("utf-8", errors="replace").strip()
 
+        for substr, compiled_regex, exceptions in file_checks:
+            if check_line(line, substr, compiled_regex, exceptions):
+                violations.append((line, substr))
 
-# Checks if any lines in a file contains a violation.
-def check_file(file_path):
+        # All checks have run on this line, so resume from the next one.
+        pos = line_end + 1
+
+    return violations
+
+
+# Returns the paths of all source files under `root_dir` to check.
+def find_files(root_dir):
+    file_paths = []
+    for directory, subdirlist, file_names in os.walk(root_dir):
+        # Prune ignored and hidden directories so that `os.walk` does not
+        # descend into them.
+        subdirlist[:] = [
+            d for d in subdirlist if d not in ignored_dirs and not d.startswith(".")
+        ]
+
+        for file_name in file_names:
+            if file_name in ignored_files:
+                continue
+
+            if not file_name.endswith(source_extensions):
+                continue
+
+            file_paths.append(os.path.join(directory, file_name))
+    return file_paths
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: <root dir>")
+        sys.exit(1)
+    root_dir = os.path.abspath(sys.argv[1])
     found_violation = False
-    with open(file_path) as f:
-        for line in f:
-            if check_line(file_path, line, "malloc", regex_malloc, malloc_exceptions):
-                found_violation = True
-            if check_line(file_path, line, "calloc", regex_calloc, calloc_exceptions):
-                found_violation = True
-            if check_line(
-                file_path, line, "realloc", regex_realloc, realloc_exceptions
-            ):
-                found_violation = True
-            if check_line(file_path, line, "free", regex_free, free_exceptions):
+    print("Checking for heap memory API violations in " + root_dir)
+
+    # Files are checked in parallel worker processes; violations are reported
+    # here, in file order, so that the output is deterministic.
+    file_paths = find_files(root_dir)
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(check_file, file_paths, chunksize=32)
+        for file_path, violations in zip(file_paths, results):
+            for line, substr in violations:
+                report_violation(file_path, line, substr)
                 found_violation = True
-            if check_line(file_path, line, "new", regex_new, None):
-                found_violation = True
-            if check_line(file_path, line, "delete", regex_delete, None):
-                found_violation = True
-            if check_line(
-                file_path,
-                line,
-                "shared_ptr<",
-                regex_shared_ptr,
-                shared_ptr_exceptions,
-            ):
-                found_violation = True
-            if check_line(
-                file_path,
-                line,
-                "make_shared<",
-                regex_make_shared,
-                make_shared_exceptions,
-            ):
-                found_violation = True
-            if check_line(
-                file_path,
-                line,
-                "unique_ptr<",
-                regex_unique_ptr,
-                unique_ptr_exceptions,
-            ):
-                found_violation = True
-    return found_violation
-
-
-if len(sys.argv) < 2:
-    print("Usage: <root dir>")
-    sys.exit(1)
-root_dir = os.path.abspath(sys.argv[1])
-found_violation = False
-print("Checking for heap memory API violations in " + root_dir)
-for directory, subdirlist, file_names in os.walk(root_dir):
-    if os.path.basename(os.path.normpath(directory)) in ignored_dirs:
-        continue
-
-    for file_name in file_names:
-        if file_name in ignored_files:
-            continue
-
-        if not file_name.endswith(".h") and not file_name.endswith(".cc"):
-            continue
-
-        file_path = os.path.join(directory, file_name)
-        if check_file(file_path):
-            found_violation = True
-
-if found_violation:
-    error_msg = (
-        "Detected heap memory API violations!\n"
-        "Source files within TileDB must use the heap memory APIs "
-        "defined in tiledb/common/heap_memory.h\n"
-        "Either correct your changes or add an exception within " + __file__
-    )
-    print(error_msg)
-    exit(1)
-else:
-    print("Did not detect heap memory API violations.")
-    sys.exit(0)
+
+    if found_violation:
+        error_msg = (
+            "Detected heap memory API violations!\n"
+            "Source files within TileDB must use the heap memory APIs "
+            "defined in tiledb/common/heap_memory.h\n"
+            "Either correct your changes or add an exception within " + __file__
+        )
+        print(error_msg)
+        exit(1)
+    else:
+        print("Did not detect heap memory API violations.")
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
-import itertools as it
+from __future__ import annotations
+
+import re
 import sys
-from operator import itemgetter
-from typing import Mapping, Sequence
+from collections import defaultdict
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
 
 
 type_mapping = {
@@ -20,32 +23,37 @@ type_mapping = {
 }
 
 
+# Returns a regex matching the lines that start with one of `tags`, capturing the
+# tag and the stripped text that follows it.
+@lru_cache(maxsize=None)
+def tagged_line_regex(*tags: str) -> re.Pattern:
+    alternation = "|".join(map(re.escape, tags))
+    return re.compile(
+        rf"^[^\S\n]*({alternation})[^\S\n]*(.*?)[^\S\n]*$", flags=re.MULTILINE
+    )
+
+
 def parse_pr_body(
     body: str, type_tag: str = "TYPE:", description_tag: str = "DESC:"
 ) -> Mapping[str, Sequence[str]]:
     headers = []
     descriptions = []
-    for line in body.strip().split("\n"):
-        line = line.strip()
-        if line.startswith(type_tag):
-            change_type = line[len(type_tag) :].strip()
+    for tag, text in tagged_line_regex(type_tag, description_tag).findall(body):
+        if tag == type_tag:
             try:
-                headers.append(type_mapping[change_type])
+                headers.append(type_mapping[text])
             except KeyError:
-                raise ValueError(f"Unknown history type: {change_type}")
-
-        elif line.startswith(description_tag):
-            descriptions.append(line[len(description_tag) :].strip())
+                raise ValueError(f"Unknown history type: {text}")
+        else:
+            descriptions.append(text)
 
     if len(headers) != len(descriptions):
         raise ValueError("Mismatched number of history types and descriptions")
 
-    get_header, get_description = itemgetter(0), itemgetter(1)
-    header_descriptions = sorted(zip(headers, descriptions), key=get_header)
-    return {
-        header: list(map(get_description, group))
-        for header, group in it.groupby(header_descriptions, key=get_header)
-    }
+    header_descriptions = defaultdict(list)
+    for header, description in zip(headers, descriptions):
+        header_descriptions[header].append(description)
+    return dict(header_descriptions)
 
 
 def main():
@@ -2,15 +2,40 @@
 
 import argparse
 import logging
+import os
 import re
+import shutil
 import sys
+import tempfile
 from subprocess import check_output
-from typing import Any, Dict, List, Optional
+from typing import Dict, List, Optional, Pattern, Tuple
 
-from github import Github
+from github import Auth, Github, GithubRetry
+from urllib3.util.retry import Retry
 
 from parse_pr import parse_pr_body, type_mapping
 
+# Buffer size used when rewriting `HISTORY.md`.
+HISTORY_BUFFER_SIZE = 1 << 20
+
+# Number of commits or PRs looked up per GraphQL query.
+GRAPHQL_BATCH_SIZE = 100
+
+# Matches a valid release version.
+RELEASE_VERSION_RE = re.compile(r"\d+\.\d+\.\d+")
+
+# Matches the head ref of a backport PR, capturing the number of the original PR.
+BACKPORT_RE = re.compile(r"^backport-(\d+)")
+
+# Patterns replaced by `update_version`. They are anchored to whole lines, so a
+# match attempt fails immediately anywhere but at the start of a line.
+HISTORY_IN_PROGRESS_RE = re.compile(r"^# In Progress$", re.MULTILINE)
+VERSION_MAJOR_RE = re.compile(r"^#define TILEDB_VERSION_MAJOR \d+$", re.MULTILINE)
+VERSION_MINOR_RE = re.compile(r"^#define TILEDB_VERSION_MINOR \d+$", re.MULTILINE)
+VERSION_PATCH_RE = re.compile(r"^#define TILEDB_VERSION_PATCH \d+$", re.MULTILINE)
+DOC_VERSION_RE = re.compile(r"^version = '\d+\.\d+'$", re.MULTILINE)
+DOC_RELEASE_RE = re.compile(r"^release = '\d+\.\d+\.\d+'$", re.MULTILINE)
+
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Prepare next TileDB release")
@@ -29,16 +54,31 @@ def main() -> None:
     )
     args = parser.parse_args()
 
-    version_re = r"^\d+\.\d+\.\d+$"
-    if not re.match(version_re, args.version):
-        sys.exit(f"Invalid version '{args.version}': must match '{version_re}'")
+    if not RELEASE_VERSION_RE.fullmatch(args.version):
+        sys.exit(
+            f"Invalid version '{args.version}': "
+            f"must match '{RELEASE_VERSION_RE.pattern}'"
+        )
 
-    prs = find_prs(Github(args.token), args.head, args.base)
+    prs = find_prs(create_github(args.token), args.head, args.base)
     update_history(args.version, prs)
 
     update_version(args.version)
 
 
+def create_github(token: Optional[str]) -> Github:
+    auth = Auth.Token(token) if token is not None else None
+    return Github(auth=auth, retry=github_retry())
+
+
+def github_retry() -> GithubRetry:
+    # Retry transient failures instead of aborting the release preparation.
+    # GithubRetry also waits out primary and secondary rate limits, which GitHub
+    # signals with 403 responses. GraphQL queries are sent with POST but are safe
+    # to retry.
+    return GithubRetry(allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"})
+
+
 def find_prs(gh: Github, head: str, base: Optional[str] = None) -> Dict[int, str]:
     repo = gh.get_repo("TileDB-Inc/TileDB")
 
@@ -64,16 +104,41 @@ def find_prs(gh: Github, head: str, base: Optional[str] = None) -> Dict[int, str
         raise ValueError("Head is not ahead of base")
     logging.info(f"Head is {comparison.ahead_by} commits ahead of base")
 
+    # The GraphQL API requires authentication; fall back to one REST request per
+    # commit without a token.
+    if gh.requester.auth is None:
+        pulls = [
+            (pr.number, pr.head.ref, pr.body)
+            for commit in comparison.commits
+            for pr in commit.get_pulls()
+        ]
+    else:
+        pulls = find_commit_pulls(gh, [commit.sha for commit in comparison.commits])
+
+    # Map the head refs of backport PRs to the number of the PR they backport, and
+    # fetch the bodies of those PRs.
+    backport_refs = {}
+    for _, pr_head_ref, _ in pulls:
+        backport = BACKPORT_RE.match(pr_head_ref)
+        if backport:
+            backport_refs[pr_head_ref] = int(backport.group(1))
+    backported_numbers = sorted(set(backport_refs.values()))
+    if gh.requester.auth is None:
+        backported = {
+            number: repo.get_pull(number).body for number in backported_numbers
+        }
+    else:
+        backported = find_pull_bodies(gh, backported_numbers)
+
     prs = {}
-    for commit in comparison.commits:
-        for pr in commit.get_pulls():
-            backport = re.match(r"^backport-(\d+)", pr.head.ref)
-            if backport:
-                pr = repo.get_pull(int(backport.group(1)))
-            # If the reserved keyword "NO_HISTORY" is included anywhere in the PR body,
-            # ignore the PR
-            if "NO_HISTORY" not in pr.body:
-                prs[pr.number] = pr.body
+    for pr_number, pr_head_ref, pr_body in pulls:
+        if pr_head_ref in backport_refs:
+            pr_number = backport_refs[pr_head_ref]
+            pr_body = backported[pr_number]
+        # If the reserved keyword "NO_HISTORY" is included anywhere in the PR body,
+        # ignore the PR
+        if "NO_HISTORY" not in pr_body:
+            prs[pr_number] = pr_body
 
     logging.info(
         f"{len(prs)} unique PRs with HISTORY notes found related to commits between "
@@ -82,6 +147,62 @@ def find_prs(gh: Github, head: str, base: Optional[str] = None) -> Dict[int, str
     return prs
 
 
+def find_commit_pulls(gh: Github, shas: List[str]) -> List[Tuple[int, str, str]]:
+    # Look up the PRs associated with the commits in batches with the GraphQL API,
+    # through the client's keep-alive connection, rather than with one REST
+    # request per commit.
+    pulls = []
+    for i in range(0, len(shas), GRAPHQL_BATCH_SIZE):
+        commits = "\n".join(
+            f'c{j}: object(oid: "{sha}") {{ ...CommitPulls }}'
+            for j, sha in enumerate(shas[i : i + GRAPHQL_BATCH_SIZE])
+        )
+        query = f"""
+            query {{
+                repository(owner: "TileDB-Inc", name: "TileDB") {{
+                    {commits}
+                }}
+            }}
+            fragment CommitPulls on Commit {{
+                associatedPullRequests(first: 10) {{
+                    nodes {{ number headRefName body }}
+                }}
+            }}
+        """
+        # Raises GithubException on errors, including errors in the query result.
+        _, result = gh.requester.graphql_query(query, {})
+
+        for commit in result["data"]["repository"].values():
+            for pr in commit["associatedPullRequests"]["nodes"]:
+                pulls.append((pr["number"], pr["headRefName"], pr["body"]))
+
+    return pulls
+
+
+def find_pull_bodies(gh: Github, numbers: List[int]) -> Dict[int, str]:
+    # Look up the bodies of PRs by number in batches with the GraphQL API, rather
+    # than with one REST request per PR.
+    bodies = {}
+    for i in range(0, len(numbers), GRAPHQL_BATCH_SIZE):
+        pulls = "\n".join(
+            f"p{number}: pullRequest(number: {number}) {{ number body }}"
+            for number in numbers[i : i + GRAPHQL_BATCH_SIZE]
+        )
+        query = f"""
+            query {{
+                repository(owner: "TileDB-Inc", name: "TileDB") {{
+                    {pulls}
+                }}
+            }}
+        """
+        _, result = gh.requester.graphql_query(query, {})
+
+        for pr in result["data"]["repository"].values():
+            bodies[pr["number"]] = pr["body"]
+
+    return bodies
+
+
 def update_history(version: str, prs: Dict[int, str]) -> None:
     sections: Dict[str, List[str]] = {header: [] for header in type_mapping.values()}
     for pr_number, pr_body in prs.items():
@@ -90,76 +211,68 @@ def update_history(version: str, prs: Dict[int, str]) -> None:
             for description in descriptions:
                 sections[header].append(f"* {description} [#{pr_number}]({pull_url})")
 
-    # Read `HISTORY.md` into memory.
-    with open("HISTORY.md") as f:
-        current_history = f.read()
-
-    # Overwrite `HISTORY.md` with the new lines
-    with open("HISTORY.md", "w") as f:
-        print(f"# TileDB v{version} Release Notes", file=f)
-        for header, lines in sections.items():
-            # ignore empty subsections
-            if header.startswith("###") and not lines:
-                continue
-            print(file=f)
-            print(header, file=f)
-            for line in lines:
-                print(line, file=f)
+    new_lines = [f"# TileDB v{version} Release Notes"]
+    for header, lines in sections.items():
+        # ignore empty subsections
+        if header.startswith("###") and not lines:
+            continue
+        new_lines.append("")
+        new_lines.append(header)
+        new_lines.extend(lines)
+    # separate the new lines from the current history
+    new_lines.append("\n")
 
-        # append the current history
-        print(file=f)
-        f.write(current_history)
+    # Write the new lines followed by the current history to a temporary file,
+    # streaming the latter instead of reading it all into memory, then replace
+    # `HISTORY.md` with it. Both files use a large buffer so that the copy takes
+    # few read/write calls. The temporary file is removed if anything fails, so
+    # that it is not left behind in the checkout.
+    with open("HISTORY.md", buffering=HISTORY_BUFFER_SIZE) as current:
+        f = tempfile.NamedTemporaryFile(
+            "w", buffering=HISTORY_BUFFER_SIZE, dir=".", delete=False
+        )
+        try:
+            with f:
+                f.write("\n".join(new_lines))
+                shutil.copyfileobj(current, f, HISTORY_BUFFER_SIZE)
+            shutil.copymode("HISTORY.md", f.name)
+            os.replace(f.name, "HISTORY.md")
+        except BaseException:
+            os.unlink(f.name)
+            raise
 
 
 def update_version(version: str) -> None:
     # 1. Replace "In Progress" in HISTORY.md
     replace_in_file(
         "HISTORY.md",
-        dict(
-            pattern=r"# In Progress\n",
-            repl=f"# TileDB v{version} Release Notes\n",
-        ),
+        (HISTORY_IN_PROGRESS_RE, f"# TileDB v{version} Release Notes"),
     )
 
     # 2. replace major, minor, patch in tiledb/sm/c_api/tiledb_version.h
     major, minor, patch = version.split(".")
     replace_in_file(
         "tiledb/sm/c_api/tiledb_version.h",
-        dict(
-            pattern=r"#define TILEDB_VERSION_MAJOR \d+\n",
-            repl=f"#define TILEDB_VERSION_MAJOR {major}\n",
-        ),
-        dict(
-            pattern=r"#define TILEDB_VERSION_MINOR \d+\n",
-            repl=f"#define TILEDB_VERSION_MINOR {minor}\n",
-        ),
-        dict(
-            pattern=r"#define TILEDB_VERSION_PATCH \d+\n",
-            repl=f"#define TILEDB_VERSION_PATCH {patch}\n",
-        ),
+        (VERSION_MAJOR_RE, f"#define TILEDB_VERSION_MAJOR {major}"),
+        (VERSION_MINOR_RE, f"#define TILEDB_VERSION_MINOR {minor}"),
+        (VERSION_PATCH_RE, f"#define TILEDB_VERSION_PATCH {patch}"),
     )
 
     # 3. replace version and release in doc/source/conf.py
     replace_in_file(
         "doc/source/conf.py",
-        dict(
-            pattern=r"version = '\d+\.\d+'\n",
-            repl=f"version = '{major}.{minor}'\n",
-        ),
-        dict(
-            pattern=r"release = '\d+\.\d+\.\d+'\n",
-            repl=f"release = '{major}.{minor}.{patch}'\n",
-        ),
+        (DOC_VERSION_RE, f"version = '{major}.{minor}'"),
+        (DOC_RELEASE_RE, f"release = '{major}.{minor}.{patch}'"),
     )
 
 
-def replace_in_file(path: str, *replacement_kwargs: Dict[str, Any]) -> None:
+def replace_in_file(path: str, *replacements: Tuple[Pattern[str], str]) -> None:
     with open(path) as f:
         text = f.read()
 
     new_text = text
-    for kwargs in replacement_kwargs:
-        new_text = re.sub(string=new_text, **kwargs)
+    for pattern, repl in replacements:
+        new_text = pattern.sub(repl, new_text)
 
     if new_text != text:
         with open(path, "w") as f:
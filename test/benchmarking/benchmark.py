@@ -1,19 +1,29 @@
 #!/usr/bin/env python
 
 import argparse
-import glob
+import ctypes
 import json
 import os
+import shutil
 import subprocess
 import sys
 import threading
-import time
 
 benchmark_src_dir = os.path.abspath('src')
 benchmark_build_dir = os.path.abspath('build')
 
 NUM_TRIALS = 3
 
+# A trial is abandoned once its wallclock time exceeds this multiple of the
+# fastest trial so far (but never before MIN_TRIAL_TIMEOUT_S): only the minimum
+# is reported, so a slower trial cannot change the result.
+TRIAL_TIMEOUT_FACTOR = 3
+MIN_TRIAL_TIMEOUT_S = 1.0
+
+# Directories (relative to the build directory) of the arrays that the
+# benchmark programs create in their setup phase.
+BENCHMARK_ARRAY_DIRS = ('bench_array', 'dense_bench_array', 'sparse_bench_array')
+
 if os.name == 'posix':
     if sys.platform == 'darwin':
         os_name = 'mac'
@@ -27,27 +37,31 @@ elif os.name == 'nt':
 
 
 class ProgressBar(threading.Thread):
-    def __init__(self):
+    def __init__(self, quiet=False):
         super(ProgressBar, self).__init__()
-        self.running = False
+        self.quiet = quiet
+        self.stopped = threading.Event()
         self.start()
 
     def start(self):
-        self.running = True
+        # Only draw the spinner on an interactive terminal.
+        if self.quiet or not sys.stdout.isatty():
+            return
         super(ProgressBar, self).start()
 
     def run(self):
         chars = ['-', '\\', '|', '/']
         i = 0
-        while self.running:
+        while not self.stopped.is_set():
             sys.stdout.write('\r{}'.format(chars[i]))
             sys.stdout.flush()
             i = (i + 1) % 4
-            time.sleep(0.2)
+            self.stopped.wait(0.2)
 
     def stop(self):
-        self.running = False
-        self.join()
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
         print('\rDone.')
         sys.stdout.flush()
 
@@ -56,8 +70,17 @@ def sync_fs():
     """Syncs local filesystem pending writes."""
     if os_name == 'windows':
         print('WARNING: FS sync unimplemented')
+    elif os_name == 'linux':
+        # Only sync the filesystem holding the benchmark data.
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = os.open(benchmark_build_dir, os.O_RDONLY)
+        try:
+            if libc.syncfs(fd) != 0:
+                os.sync()
+        finally:
+            os.close(fd)
     else:
-        subprocess.call(['sudo', 'sync'])
+        os.sync()
 
 
 def drop_fs_caches():
@@ -71,6 +94,45 @@ def drop_fs_caches():
         print('WARNING: FS cache drop unimplemented')
 
 
+def drop_file_caches(path):
+    """
+    Flushes and drops the page cache of every file under the given directory,
+    leaving the rest of the page cache alone.
+
+    :param path: directory path
+    """
+    for directory, _, file_names in os.walk(path):
+        for file_name in file_names:
+            fd = os.open(os.path.join(directory, file_name), os.O_RDONLY)
+            try:
+                # Dirty pages are not dropped, so write them back first.
+                os.fdatasync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def drop_benchmark_caches(args):
+    """
+    Drops the caches of the benchmark arrays before a trial. On Linux only the
+    arrays' files are dropped, unless --system-sync is given; elsewhere the
+    whole filesystem is synced and its caches dropped.
+
+    :param args: argparse args instance
+    """
+    if os_name == 'linux' and not args.system_sync:
+        paths = [os.path.join(benchmark_build_dir, d)
+                 for d in BENCHMARK_ARRAY_DIRS]
+        paths = [p for p in paths if os.path.isdir(p)]
+        if not paths:
+            print('WARNING: no benchmark array found, caches not dropped')
+        for path in paths:
+            drop_file_caches(path)
+    else:
+        sync_fs()
+        drop_fs_caches()
+
+
 def find_tiledb_path(args):
     """
     Returns the path to the TileDB installation, or None if it can't be determined.
@@ -88,15 +150,34 @@ def find_tiledb_path(args):
     return None
 
 
+def parse_cpu_list(cpu_list):
+    """
+    Parses a CPU list such as '2,3' or '0-3,6' into a set of CPU numbers.
+
+    :param cpu_list: comma-separated CPU numbers and ranges
+    :return: set of CPU numbers
+    """
+    cpus = set()
+    for part in cpu_list.split(','):
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
 def list_benchmarks(show=False):
     """Returns a list of benchmark program names."""
-    executables = glob.glob(os.path.join(benchmark_build_dir, 'bench_*'))
     names = []
-    for exe in sorted(executables):
-        is_exec = os.path.isfile(exe) and os.access(exe, os.X_OK)
-        if is_exec:
-            name = os.path.basename(exe)
-            names.append(name)
+    try:
+        # DirEntry.is_file() is answered from the directory listing, so only
+        # the access check needs a syscall per candidate.
+        with os.scandir(benchmark_build_dir) as entries:
+            for entry in entries:
+                if (entry.name.startswith('bench_') and entry.is_file() and
+                        os.access(entry.path, os.X_OK)):
+                    names.append(entry.name)
+    except FileNotFoundError:
+        pass
+    names.sort()
 
     if show:
         print('{} benchmarks:'.format(len(names)))
@@ -106,30 +187,100 @@ def list_benchmarks(show=False):
     return names
 
 
-def build_benchmarks(args):
-    """Builds all the benchmark programs."""
+def build_benchmarks(args, tiledb_path):
+    """
+    Builds all the benchmark programs.
+
+    :param args: argparse args instance
+    :param tiledb_path: Path to the TileDB installation (see find_tiledb_path)
+    """
     if not os.path.exists(benchmark_build_dir):
         os.mkdir(benchmark_build_dir)
-    tiledb_path = find_tiledb_path(args)
     print('Building benchmarks...')
-    p = ProgressBar()
+    p = ProgressBar(args.quiet)
+    cmake_args = ['cmake', '-DCMAKE_PREFIX_PATH={}'.format(tiledb_path)]
+    # The generator of an existing build directory cannot be changed.
+    configured = os.path.exists(
+        os.path.join(benchmark_build_dir, 'CMakeCache.txt'))
+    if not configured and shutil.which('ninja') is not None:
+        cmake_args += ['-G', 'Ninja']
     try:
+        subprocess.check_output(cmake_args + [benchmark_src_dir],
+                                cwd=benchmark_build_dir)
+        # The job count is passed to the native tool (make or ninja):
+        # 'cmake --build --parallel' needs CMake 3.12.
         subprocess.check_output(
-            ['cmake', '-DCMAKE_PREFIX_PATH={}'.format(tiledb_path),
-             benchmark_src_dir],
+            ['cmake', '--build', '.', '--',
+             '-j{}'.format(os.cpu_count() or 1)],
             cwd=benchmark_build_dir)
-        subprocess.check_output(['make', '-j4'], cwd=benchmark_build_dir)
     finally:
         p.stop()
 
 
+def parse_task_output(lines):
+    """
+    Parses the JSON object printed by a benchmark phase, line by line as it
+    is read. Each field is printed on its own line (without separating
+    commas), so every such line is parsed as a single-member object.
+
+    :param lines: Iterable of output lines (bytes).
+    :return: Dict of the printed fields.
+    """
+    result = {}
+    for line in lines:
+        line = line.strip().rstrip(b',')
+        if line in (b'', b'{', b'}'):
+            continue
+        result.update(json.loads(b'{' + line + b'}'))
+    return result
+
+
+def run_trial(exe, timeout):
+    """
+    Runs one timed trial of a benchmark, streaming and parsing its output.
+
+    :param exe: Path of the benchmark program.
+    :param timeout: Seconds after which the trial is killed, or None.
+    :return: Dict of the printed fields, or None if the trial was killed.
+    """
+    proc = subprocess.Popen([exe, 'run'], cwd=benchmark_build_dir,
+                            stdout=subprocess.PIPE)
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        proc.kill()
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        with proc.stdout:
+            result = parse_task_output(proc.stdout)
+        returncode = proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+    if returncode != 0:
+        if timed_out.is_set():
+            return None
+        raise subprocess.CalledProcessError(returncode, [exe, 'run'])
+    return result
+
+
 def print_results(results):
     "Prints benchmark timing results."
-    print('Reporting minimum time of {} runs for each benchmark:'.format(
+    # Trials slower than the best one may have been abandoned, so report the
+    # number of completed trials per benchmark.
+    print('Reporting minimum time of up to {} runs for each benchmark:'.format(
         NUM_TRIALS))
     print('-' * 93)
     for bench in sorted(results.keys()):
-        print('{:<30s}{:>60d} ms'.format(bench, min(results[bench])))
+        times_ms = results[bench]
+        print('{:<30s}{:>50d} ms ({} of {})'.format(
+            bench, min(times_ms), len(times_ms), NUM_TRIALS))
 
 
 def run_benchmarks(args):
@@ -139,35 +290,50 @@ def run_benchmarks(args):
     else:
         benchmarks = args.benchmarks.split(',')
 
-    print('Dropping caches (you may be prompted for sudo access).')
-    drop_fs_caches()
-
+    if os_name != 'linux' or args.system_sync:
+        print('Dropping caches (you may be prompted for sudo access).')
+        drop_fs_caches()
+
+    # Pin the benchmark runs to the given CPUs so they are not migrated between
+    # cores mid-run. The affinity is set on the harness itself and inherited
+    # by the benchmark processes: a preexec_fn is not safe here, as the
+    # harness has other threads running (the trial timers).
+    if args.cpu_list is not None:
+        if os_name == 'linux':
+            os.sched_setaffinity(0, parse_cpu_list(args.cpu_list))
+        else:
+            print('WARNING: CPU pinning unimplemented')
+
+    # No progress spinner here: it would compete with the timed runs for CPU
+    # time and the terminal.
     print('Running benchmarks...')
-    p = ProgressBar()
-
-    try:
-        results = {}
-        for b in benchmarks:
-            exe = os.path.join(benchmark_build_dir, b)
-            if not os.path.exists(exe):
-                print('Error: no benchmark named "{}"'.format(b))
-                continue
-
-            subprocess.check_output([exe, 'setup'], cwd=benchmark_build_dir)
-
-            times_ms = []
-            for i in range(0, NUM_TRIALS):
-                sync_fs()
-                drop_fs_caches()
-                output_json = subprocess.check_output([exe, 'run'],
-                                                      cwd=benchmark_build_dir)
-                result = json.loads(output_json)
-                times_ms.append(result['ms'])
-            results[b] = times_ms
-
-            subprocess.check_output([exe, 'teardown'], cwd=benchmark_build_dir)
-    finally:
-        p.stop()
+    results = {}
+    for b in benchmarks:
+        exe = os.path.join(benchmark_build_dir, b)
+        if not os.path.exists(exe):
+            print('Error: no benchmark named "{}"'.format(b))
+            continue
+
+        print('  {}'.format(b))
+        subprocess.check_output([exe, 'setup'], cwd=benchmark_build_dir)
+
+        times_ms = []
+        best_ms = None
+        for i in range(0, NUM_TRIALS):
+            drop_benchmark_caches(args)
+            timeout = None
+            if best_ms is not None:
+                timeout = max(TRIAL_TIMEOUT_FACTOR * best_ms / 1000.0,
+                              MIN_TRIAL_TIMEOUT_S)
+            result = run_trial(exe, timeout)
+            if result is None:
+                # Already slower than the best trial; discard it.
+                break
+            times_ms.append(int(result['runtime_ms']))
+            best_ms = min(times_ms)
+        results[b] = times_ms
+
+        subprocess.check_output([exe, 'teardown'], cwd=benchmark_build_dir)
 
     print_results(results)
 
@@ -183,14 +349,27 @@ def main():
     parser.add_argument('-b', '--benchmarks', metavar='NAMES',
                         help='If given, one or more comma-separated names of '
                              'benchmarks to run.')
+    parser.add_argument('--cpu-list', metavar='CPUS',
+                        help='If given, run the benchmarks pinned to these '
+                             'CPUs, e.g. "2,3" or "2-3" (Linux only). Best '
+                             'combined with isolating them from the scheduler '
+                             'with the isolcpus kernel boot parameter.')
+    parser.add_argument('--system-sync', action='store_true', default=False,
+                        help='Sync the filesystem and drop all filesystem '
+                             'caches (requires sudo) before each trial. By '
+                             'default on Linux only the caches of the '
+                             'benchmark array are dropped.')
+    parser.add_argument('-q', '--quiet', action='store_true', default=False,
+                        help='Do not show a progress spinner while building.')
     args = parser.parse_args()
 
-    if find_tiledb_path(args) is None:
+    tiledb_path = find_tiledb_path(args)
+    if tiledb_path is None:
         print('Error: TileDB installation not found in directory \'{}\''.format(
             args.tiledb))
         sys.exit(1)
 
-    build_benchmarks(args)
+    build_benchmarks(args, tiledb_path)
 
     if args.list:
         list_benchmarks(show=True)
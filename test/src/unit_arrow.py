@@ -3,7 +3,6 @@ import pyarrow as pa
 import numpy as np
 import sys, os
 import tempfile
-import random
 
 from numpy.testing import assert_array_equal
 
@@ -11,21 +10,9 @@ from numpy.testing import assert_array_equal
 #          Data generators                                                   #
 # ************************************************************************** #
 
-# python 2 vs 3 compatibility
-if sys.hexversion >= 0x3000000:
-    getchr = chr
-else:
-    getchr = unichr
-
-def gen_chr(max, printable=False):
-    while True:
-        # TODO we exclude 0x0 here because the key API does not embedded NULL
-        s = getchr(random.randrange(1, max))
-        if printable and not s.isprintable():
-            continue
-        if len(s) > 0:
-            break
-    return s
+# one shared PCG64 generator for all of the test data, instead of the legacy
+# global RandomState
+rng = np.random.default_rng()
 
 def rand_datetime64_array(size, start=None, stop=None, dtype=None):
     if not dtype:
@@ -44,7 +31,7 @@ def rand_datetime64_array(size, start=None, stop=None, dtype=None):
     else:
         stop = np.datetime64(stop)
 
-    arr = np.random.randint(
+    arr = rng.integers(
         start.astype(dtype).astype(np.int64), stop.astype(dtype).astype(np.int64),
         size=size, dtype=np.int64
     )
@@ -52,11 +39,23 @@ def rand_datetime64_array(size, start=None, stop=None, dtype=None):
 
     return arr.astype(dtype)
 
-def rand_utf8(size=5):
-    return u''.join([gen_chr(0xD7FF) for _ in range(0, size)])
+# The string generators draw a whole column of strings with the given lengths
+# from a single bulk draw.
+# TODO we exclude 0x0 here because the key API does not embedded NULL
 
-def rand_ascii_bytes(size=5, printable=False):
-    return b''.join([gen_chr(127, printable).encode('utf-8') for _ in range(0,size)])
+def split_lengths(buf, lens):
+    offsets = np.concatenate(([0], np.cumsum(lens))).tolist()
+    return [buf[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+def rand_utf8_array(lens):
+    codepoints = rng.integers(1, 0xD7FF, size=lens.sum(), dtype=np.uint32)
+    # integers() only draws in native byte order; decode as little-endian
+    codepoints = codepoints.astype('<u4', copy=False)
+    return np.array(split_lengths(codepoints.tobytes().decode('utf-32-le'), lens))
+
+def rand_ascii_bytes_array(lens):
+    buf = rng.integers(1, 127, size=lens.sum(), dtype=np.uint8).tobytes()
+    return np.array(split_lengths(buf, lens))
 
 # ************************************************************************** #
 #           Test class                                                       #
@@ -81,34 +80,33 @@ class DataFactory():
     for dt in (np.int8, np.uint8, np.int16, np.uint16, np.int32, np.uint32, np.int64, np.uint64):
         key = np.dtype(dt).name
         dtinfo = np.iinfo(dt)
-        self.data[key] = np.random.randint(dtinfo.min, dtinfo.max, size=col_size, dtype=dt)
+        self.data[key] = rng.integers(dtinfo.min, dtinfo.max, size=col_size, dtype=dt)
 
     for dt in (np.float32, np.float64):
         key = np.dtype(dt).name
-        self.data[key] = np.random.rand(col_size).astype(dt)
+        self.data[key] = rng.random(col_size, dtype=dt)
 
     # var-len (strings)
-    self.data['tiledb_char'] = np.array([rand_ascii_bytes(np.random.randint(1,100))
-                                       for _ in range(col_size)])
-    self.data['utf_string1'] = np.array([rand_utf8(np.random.randint(1, 100))
-                                       for _ in range(col_size)])
+    self.data['tiledb_char'] = rand_ascii_bytes_array(
+        rng.integers(1, 100, size=col_size))
+    # both utf columns are cut from a single draw of code points
+    utf_strings = rand_utf8_array(np.concatenate(
+        (rng.integers(1, 100, size=col_size), rng.integers(0, 100, size=col_size))))
+    self.data['utf_string1'] = utf_strings[:col_size]
 
     # another version with some important cells set to empty
-    self.data['utf_string2'] = np.array([rand_utf8(np.random.randint(0, 100))
-                                       for _ in range(col_size)])
-    self.data['utf_string2'][0] = ''
-    self.data['utf_string2'][1] = ''
-    self.data['utf_string2'][3] = ''
-    self.data['utf_string2'][-1] = ''
-    self.data['utf_string2'][-2] = ''
-    self.data['utf_string2'][-3] = ''
+    self.data['utf_string2'] = utf_strings[col_size:]
+    self.data['utf_string2'][[0, 1, 3, -1, -2, -3]] = ''
 
     self.data['datetime_ns'] = rand_datetime64_array(col_size)
 
     ##########################################################################
 
-    self.arrays = [pa.array(val) for val in self.data.values()]
-    self.names = list(self.data.keys())
+    # convert all columns in one go; RecordBatch columns are plain Arrays
+    # (not ChunkedArrays), which the C++ test exports via _export_to_c
+    batch = pa.RecordBatch.from_pydict(self.data)
+    self.arrays = batch.columns
+    self.names = batch.schema.names
 
   def import_result(self, name, c_array, c_schema):
     self.results[name] = pa.Array._import_from_c(c_array, c_schema)